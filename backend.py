@@ -1,10 +1,24 @@
 from fastapi import FastAPI, HTTPException, Query
-from pydantic import BaseModel
-from typing import List, Optional
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field
+from typing import Any, Deque, Dict, List, Optional
+from collections import defaultdict, deque
 from datetime import datetime, timedelta
+from urllib.parse import urlencode
+import asyncio
+import itertools
+import orjson
 import uvicorn
 
-app = FastAPI(title="SOP Workflow API", version="1.0.0")
+
+class ORJSONResponse(JSONResponse):
+    """JSON response rendered with orjson instead of the stdlib encoder"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+app = FastAPI(title="SOP Workflow API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # =======================
 # Models
@@ -36,6 +50,15 @@ class NotificationRequest(BaseModel):
     message: str
     request_id: Optional[int] = None
 
+class BatchSubRequest(BaseModel):
+    method: str = "GET"
+    path: str
+    params: Optional[dict] = None
+    body: Optional[Any] = Field(default=None, alias="json")
+
+class BatchRequest(BaseModel):
+    requests: List[BatchSubRequest]
+
 # =======================
 # In-memory DB
 # =======================
@@ -74,8 +97,22 @@ REQUESTS_DB = {
     ),
 }
 
-TICKET_QUEUE: List[Ticket] = []
-NOTIFICATIONS_LOG: List[dict] = []
+# Bounded history; the oldest entries are dropped once full
+HISTORY_MAXLEN = 1_000_000
+TICKET_QUEUE: Deque[Ticket] = deque(maxlen=HISTORY_MAXLEN)
+NOTIFICATIONS_LOG: Deque[dict] = deque(maxlen=HISTORY_MAXLEN)
+
+# IDs come from monotonic counters so they stay unique after eviction
+_ticket_ids = itertools.count(1)
+_notification_ids = itertools.count(1)
+
+# Secondary indices kept in sync with the queues above (authoritative for lookups)
+TICKETS_BY_ID: Dict[int, Ticket] = {}
+
+# Per-request tickets/notifications, aggregated at write time for get_workflow_status
+WORKFLOW_STATE_BY_REQUEST: Dict[int, Dict[str, List[dict]]] = defaultdict(
+    lambda: {"tickets": [], "notifications": []}
+)
 
 # =======================
 # Service Layer
@@ -86,36 +123,68 @@ def get_request_by_id(request_id: int) -> Request:
         raise ValueError("Request ID not found.")
     return req
 
-def create_ticket(request_id: int, reason: str, priority: str = "medium") -> Ticket:
-    ticket_id = len(TICKET_QUEUE) + 1
+def _drop_aggregate_entry(request_id: int, kind: str) -> None:
+    """Remove the oldest ticket/notification from a request's aggregate; appends are chronological"""
+    aggregate = WORKFLOW_STATE_BY_REQUEST.get(request_id)
+    if aggregate is None or not aggregate[kind]:
+        return
+    aggregate[kind].pop(0)
+    if not aggregate["tickets"] and not aggregate["notifications"]:
+        del WORKFLOW_STATE_BY_REQUEST[request_id]
+
+def _evict_oldest_ticket() -> None:
+    """Make room in a full TICKET_QUEUE, keeping the indices consistent with it"""
+    if len(TICKET_QUEUE) < HISTORY_MAXLEN:
+        return
+    oldest = TICKET_QUEUE.popleft()
+    TICKETS_BY_ID.pop(oldest.ticket_id, None)
+    _drop_aggregate_entry(oldest.request_id, "tickets")
+
+def _evict_oldest_notification() -> None:
+    """Make room in a full NOTIFICATIONS_LOG, keeping the per-request aggregate consistent with it"""
+    if len(NOTIFICATIONS_LOG) < HISTORY_MAXLEN:
+        return
+    oldest = NOTIFICATIONS_LOG.popleft()
+    if oldest["request_id"] is not None:
+        _drop_aggregate_entry(oldest["request_id"], "notifications")
+
+def create_ticket(request_id: int, reason: str, priority: str = "medium", created_at: Optional[datetime] = None) -> Ticket:
+    ticket_id = next(_ticket_ids)
     ticket = Ticket(
         ticket_id=ticket_id,
         request_id=request_id,
         reason=reason,
-        created_at=datetime.now(),
+        created_at=created_at or datetime.now(),
         priority=priority,
         status="open"
     )
+    _evict_oldest_ticket()
     TICKET_QUEUE.append(ticket)
+    TICKETS_BY_ID[ticket_id] = ticket
+    WORKFLOW_STATE_BY_REQUEST[request_id]["tickets"].append(ticket.model_dump())
     return ticket
 
-def send_notification(recipient: str, subject: str, message: str, request_id: Optional[int] = None) -> dict:
+def send_notification(recipient: str, subject: str, message: str, request_id: Optional[int] = None, sent_at: Optional[datetime] = None) -> dict:
     """Mock notification sending"""
     notification = {
-        "id": len(NOTIFICATIONS_LOG) + 1,
+        "id": next(_notification_ids),
         "recipient": recipient,
         "subject": subject,
         "message": message,
         "request_id": request_id,
-        "sent_at": datetime.now(),
+        "sent_at": sent_at or datetime.now(),
         "status": "sent"
     }
+    _evict_oldest_notification()
     NOTIFICATIONS_LOG.append(notification)
+    if request_id is not None:
+        WORKFLOW_STATE_BY_REQUEST[request_id]["notifications"].append(notification)
     return notification
 
 def process_drive_access_sop(request_id: int) -> dict:
     request = get_request_by_id(request_id)
-    age_hours = (datetime.now() - request.created_at).total_seconds() / 3600
+    now = datetime.now()
+    age_hours = (now - request.created_at).total_seconds() / 3600
     
     if request.status == "approved":
         return {
@@ -137,7 +206,8 @@ def process_drive_access_sop(request_id: int) -> dict:
             ticket = create_ticket(
                 request_id, 
                 reason="Drive Access Re-Approval Needed",
-                priority="high"
+                priority="high",
+                created_at=now
             )
             
             # Send notification to manager
@@ -146,7 +216,8 @@ def process_drive_access_sop(request_id: int) -> dict:
                     recipient=request.manager_email,
                     subject=f"Drive Access Request {request_id} - Action Required",
                     message=f"Drive access request {request_id} has been delayed and requires re-approval.",
-                    request_id=request_id
+                    request_id=request_id,
+                    sent_at=now
                 )
             
             return {
@@ -168,15 +239,66 @@ def update_request_status(request_id: int, new_status: str) -> dict:
         "new_status": new_status
     }
 
+async def dispatch_subrequest(sub: BatchSubRequest) -> dict:
+    """Run one batched sub-request through the app in-process"""
+    if sub.path.rstrip("/") == "/batch":
+        return {"status_code": 400, "body": {"detail": "Nested batch requests are not allowed"}}
+
+    body = orjson.dumps(sub.body) if sub.body is not None else b""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": sub.method.upper(),
+        "scheme": "http",
+        "path": sub.path,
+        "raw_path": sub.path.encode(),
+        "root_path": "",
+        "query_string": urlencode(sub.params or {}, doseq=True).encode(),
+        "headers": [
+            (b"host", b"batch"),
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ],
+        "client": None,
+        "server": None,
+    }
+    request_sent = False
+    status_code = 500
+    chunks: List[bytes] = []
+
+    async def receive():
+        nonlocal request_sent
+        if request_sent:
+            return {"type": "http.disconnect"}
+        request_sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        nonlocal status_code
+        if message["type"] == "http.response.start":
+            status_code = message["status"]
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+
+    raw = b"".join(chunks)
+    try:
+        content = orjson.loads(raw) if raw else None
+    except orjson.JSONDecodeError:
+        content = raw.decode(errors="replace")
+    return {"status_code": status_code, "body": content}
+
 # =======================
 # API Routes
 # =======================
 @app.get("/")
-def root():
+async def root():
     return {"message": "SOP Workflow API is running.", "version": "1.0.0"}
 
 @app.get("/health")
-def health_check():
+async def health_check():
     return {
         "status": "healthy",
         "timestamp": datetime.now(),
@@ -186,7 +308,7 @@ def health_check():
     }
 
 @app.get("/sop/drive-access")
-def drive_access_sop(request_id: int = Query(..., description="ID of the access request")):
+async def drive_access_sop(request_id: int = Query(..., description="ID of the access request")):
     """Main SOP endpoint for drive access workflow"""
     try:
         return process_drive_access_sop(request_id)
@@ -194,21 +316,21 @@ def drive_access_sop(request_id: int = Query(..., description="ID of the access
         raise HTTPException(status_code=404, detail=str(e))
 
 @app.get("/requests/{request_id}")
-def get_request(request_id: int):
+async def get_request(request_id: int):
     """Get specific request details"""
     try:
         request = get_request_by_id(request_id)
-        return request
+        return ORJSONResponse(request.model_dump())
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
 @app.get("/requests")
-def list_requests():
+async def list_requests():
     """List all requests"""
-    return {"requests": list(REQUESTS_DB.values())}
+    return ORJSONResponse({"requests": [r.model_dump() for r in REQUESTS_DB.values()]})
 
 @app.patch("/requests/{request_id}/status")
-def update_request_status_endpoint(request_id: int, status: str = Query(..., description="New status")):
+async def update_request_status_endpoint(request_id: int, status: str = Query(..., description="New status")):
     """Update request status"""
     try:
         return update_request_status(request_id, status)
@@ -216,20 +338,20 @@ def update_request_status_endpoint(request_id: int, status: str = Query(..., des
         raise HTTPException(status_code=404, detail=str(e))
 
 @app.get("/tickets")
-def list_tickets():
+async def list_tickets():
     """List all tickets"""
-    return {"tickets": TICKET_QUEUE}
+    return ORJSONResponse({"tickets": [t.model_dump() for t in TICKET_QUEUE]})
 
 @app.get("/tickets/{ticket_id}")
-def get_ticket(ticket_id: int):
+async def get_ticket(ticket_id: int):
     """Get specific ticket details"""
-    ticket = next((t for t in TICKET_QUEUE if t.ticket_id == ticket_id), None)
+    ticket = TICKETS_BY_ID.get(ticket_id)
     if not ticket:
         raise HTTPException(status_code=404, detail="Ticket not found")
     return ticket
 
 @app.post("/tickets")
-def create_ticket_endpoint(request_id: int, reason: str, priority: str = "medium"):
+async def create_ticket_endpoint(request_id: int, reason: str, priority: str = "medium"):
     """Create a new ticket"""
     try:
         # Verify request exists
@@ -240,7 +362,7 @@ def create_ticket_endpoint(request_id: int, reason: str, priority: str = "medium
         raise HTTPException(status_code=404, detail=str(e))
 
 @app.post("/notifications")
-def send_notification_endpoint(notification: NotificationRequest):
+async def send_notification_endpoint(notification: NotificationRequest):
     """Send a notification"""
     result = send_notification(
         recipient=notification.recipient,
@@ -251,12 +373,12 @@ def send_notification_endpoint(notification: NotificationRequest):
     return result
 
 @app.get("/notifications")
-def list_notifications():
+async def list_notifications():
     """List all sent notifications"""
-    return {"notifications": NOTIFICATIONS_LOG}
+    return ORJSONResponse({"notifications": list(NOTIFICATIONS_LOG)})
 
 @app.post("/user-input")
-def process_user_input(input_data: UserInput):
+async def process_user_input(input_data: UserInput):
     """Process user input for workflow steps"""
     return {
         "message": "User input processed successfully",
@@ -267,22 +389,32 @@ def process_user_input(input_data: UserInput):
     }
 
 @app.get("/workflow/status/{request_id}")
-def get_workflow_status(request_id: int):
+async def get_workflow_status(request_id: int):
     """Get comprehensive workflow status"""
     try:
         request = get_request_by_id(request_id)
-        related_tickets = [t for t in TICKET_QUEUE if t.request_id == request_id]
-        related_notifications = [n for n in NOTIFICATIONS_LOG if n.get("request_id") == request_id]
+        aggregates = WORKFLOW_STATE_BY_REQUEST.get(request_id)
         
-        return {
-            "request": request,
-            "related_tickets": related_tickets,
-            "notifications": related_notifications,
+        return ORJSONResponse({
+            "request": request.model_dump(),
+            "related_tickets": aggregates["tickets"] if aggregates else [],
+            "notifications": aggregates["notifications"] if aggregates else [],
             "workflow_complete": request.status == "approved"
-        }
+        })
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
+@app.post("/batch")
+async def batch_endpoint(batch: BatchRequest):
+    """Execute several API calls concurrently in one round trip"""
+    results = await asyncio.gather(*(dispatch_subrequest(sub) for sub in batch.requests), return_exceptions=True)
+    # One failing sub-request must not take down the others' results
+    responses = [
+        {"status_code": 500, "body": {"detail": str(result)}} if isinstance(result, Exception) else result
+        for result in results
+    ]
+    return {"responses": responses}
+
 # =======================
 # Development Server
 # =======================
@@ -1,29 +1,57 @@
+import logging
+import logging.handlers
+import os
 import re
-from typing import Literal, List, Dict, Any, Optional
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal, List, Deque, Dict, Any, Optional, Set, Tuple
 from typing_extensions import TypedDict
 from langgraph.graph import StateGraph, END
 import ollama
 import pprint
-import json
+import orjson
 import requests
 from datetime import datetime
 from global_action_repository.drive_access_request_handler import drive_gar
 
-from graph_utils import LLMTools
+from graph_utils import CachedOllamaClient, LLMBackend, LLMTools, StepSelectionCache
 import prompts
 from sop_worflows import drive_access
 
 pp = pprint.PrettyPrinter(indent=2, width=100)
+logger = logging.getLogger(__name__)
 
-# Ollama client setup
-client = ollama.Client()
-model = "llama3:8b"
+# LLM client setup: Ollama by default, or an OpenAI-compatible server (e.g. vLLM)
+# when SOP_LLM_BASE_URL is set, e.g. http://vllm:8000/v1
+LLM_BASE_URL = os.environ.get("SOP_LLM_BASE_URL")
+client = LLMBackend(LLM_BASE_URL) if LLM_BASE_URL else ollama.Client()
+# SOP_LLM_CACHE=0 sends every call to the model, e.g. when cached answers are suspect
+LLM_CACHE_ENABLED = os.environ.get("SOP_LLM_CACHE", "1") != "0"
+LLM_CACHE_PATH = os.path.expanduser("~/.sop_llm_cache.db")
+cached_client = CachedOllamaClient(client, persist_path=LLM_CACHE_PATH)
+STEP_CACHE_PATH = os.path.expanduser("~/.sop_step_cache")
+step_cache = StepSelectionCache(STEP_CACHE_PATH)
+# 4-bit quantized weights: roughly a quarter of the memory traffic per decoded token
+model = os.environ.get("SOP_LLM_MODEL", "llama3:8b-instruct-q4_K_M")
+# Cap the context (the prompts fit comfortably) and prefill in large batches;
+# greedy decoding keeps responses deterministic and therefore cacheable
+LLM_OPTIONS = {"num_ctx": 4096, "num_batch": 512, "temperature": 0}
+
+# Prompts show the last few entries in full and older ones only as a one-line
+# summary, so little history needs to be kept
+MAX_EXECUTION_MEMORY = 8
+
+# Log records are written out in small batches rather than one flush per line;
+# kept small so the simulated conversation still appears as the run progresses
+LOG_BUFFER_RECORDS = 16
 
 # State definitions
 class ExecutionMemoryDict(TypedDict):
     action: str
     observation: str
     feedback: str
+    rendered: str
 
 class GlobalAction(TypedDict):
     action: str
@@ -34,14 +62,101 @@ class GlobalAction(TypedDict):
 
 class State(TypedDict):
     sop_workflow: str
-    execution_memory: List[ExecutionMemoryDict]
+    execution_memory: Deque[ExecutionMemoryDict]
+    memory_summary: str
     global_action_repository: List[GlobalAction]
     current_step: str
     available_steps: List[str]
+    available_steps_set: Set[str]
+    step_selection_system: str
+    tool_execution_system: str
+    sop_is_linear: bool
     completed_steps: List[str]
+    completed_steps_set: Set[str]
     workflow_complete: bool
     tool_results: Dict[str, Any]
     user_context: Dict[str, Any]
+    next_step_hint: Optional[str]
+
+
+# ===================
+# SOP PARSING
+# ===================
+def parse_sop_steps(sop_workflow: str) -> List[str]:
+    """Split SOP text into its non-empty, stripped step lines"""
+    return [s.strip() for s in sop_workflow.splitlines() if s.strip()]
+
+
+_BRANCH_WORDS_RE = re.compile(r"\b(if|unless|depending|else|otherwise|either)\b", re.IGNORECASE)
+
+
+def is_linear_sop(sop_workflow: str) -> bool:
+    """True when no step is conditional, so steps simply run in order"""
+    return _BRANCH_WORDS_RE.search(sop_workflow) is None
+
+
+# ===================
+# TOOL CALL SCHEDULING
+# ===================
+# User-facing tools run alone and in order; everything else in a step may overlap
+SEQUENTIAL_TOOLS = {"ask_user_input", "show_message_to_user"}
+tool_executor = ThreadPoolExecutor(max_workers=4)
+
+# Shared across steps so mock tickets, notifications and cached tool results persist
+llm_tools = LLMTools()
+
+
+def group_tool_calls(tool_calls: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """Split tool calls into ordered groups; calls within a group are independent"""
+    groups: List[List[Dict[str, Any]]] = []
+    current: List[Dict[str, Any]] = []
+    for tool_call in tool_calls:
+        if tool_call.get("tool_name") in SEQUENTIAL_TOOLS:
+            if current:
+                groups.append(current)
+                current = []
+            groups.append([tool_call])
+        else:
+            current.append(tool_call)
+    if current:
+        groups.append(current)
+    return groups
+
+
+def run_tool_call(tools: LLMTools, tool_call: Dict[str, Any]) -> Dict[str, Any]:
+    tool_name = tool_call.get("tool_name")
+    logger.debug("🔧 Executing tool: %s", tool_name)
+    return tools.execute_tool(tool_name, tool_call.get("parameters", {}))
+
+
+def check_context_budget(system: str, prompt: str) -> None:
+    """Warn when a prompt likely exceeds num_ctx; Ollama would otherwise truncate it silently"""
+    estimated = prompts.estimate_tokens(system, prompt)
+    if estimated > LLM_OPTIONS["num_ctx"]:
+        logger.warning("⚠️ Prompt is ~%d tokens, over the %d-token context", estimated, LLM_OPTIONS["num_ctx"])
+
+
+def last_tool_outcome(execution_memory: Deque[ExecutionMemoryDict]) -> Tuple[Optional[str], Optional[bool]]:
+    """Name and success flag of the most recent tool call, or (None, None) if there was none"""
+    if not execution_memory:
+        return None, None
+    observation = execution_memory[-1]["observation"]
+    if not isinstance(observation, list):
+        return None, False
+    if not observation:
+        return None, None
+    last = observation[-1]
+    return last.get("tool_name"), bool(last.get("result", {}).get("success"))
+
+
+def record_memory(state: State, entry: ExecutionMemoryDict) -> str:
+    """Append entry to execution memory; returns the summary updated with the entry leaving the recent window"""
+    execution_memory = state["execution_memory"]
+    execution_memory.append(entry)
+    memory_summary = state.get("memory_summary", "")
+    if len(execution_memory) > prompts.RECENT_MEMORY_ENTRIES:
+        memory_summary = prompts.fold_into_summary(memory_summary, execution_memory[-prompts.RECENT_MEMORY_ENTRIES - 1])
+    return memory_summary
 
 
 # ===================
@@ -49,180 +164,215 @@ class State(TypedDict):
 # ===================
 def intelligent_step_selection_node(state: State):
     """Select next step and determine required tools"""
-    # Initialize available steps if not present
-    if not state.get("available_steps"):
-        available_steps = [s.strip() for s in state["sop_workflow"].split("\n") if s.strip()]
-        state["available_steps"] = available_steps
-        state["completed_steps"] = []
-    else:
-        available_steps = state["available_steps"]
-    
+    available_steps = state["available_steps"]
     execution_memory = state.get("execution_memory", [])
     completed_steps = state.get("completed_steps", [])
+    completed_steps_set = state.get("completed_steps_set", set())
     
-    print(f"\n🔄 STEP SELECTION:")
-    print(f"Available steps: {len(available_steps)}")
-    print(f"Completed steps: {len(completed_steps)}")
-    print(f"Execution memory entries: {len(execution_memory)}")
+    logger.debug("🔄 STEP SELECTION: %d available, %d completed, %d memory entries",
+                 len(available_steps), len(completed_steps), len(execution_memory))
     
     # Check if workflow is complete
     if len(completed_steps) >= len(available_steps):
-        print("✅ All workflow steps completed!")
+        logger.info("✅ All workflow steps completed!")
         return {
-            **state,
             "workflow_complete": True
         }
     
     # ⚠️ FIRST-RUN LOGIC: If execution memory is empty, pick the first step directly
     if len(execution_memory) == 0:
         next_step = available_steps[0]
-        print(f"🚀 First step selected: {next_step}")
+        logger.info("🚀 First step selected: %s", next_step)
         return {
-            **state,
             "current_step": next_step,
             "required_tools": [],
             "workflow_complete": False
         }
     
+    # Linear SOP and the last step went fine: the next step is simply the next one in order
+    if state.get("sop_is_linear") and execution_memory[-1]["feedback"] != "completed_with_error":
+        next_step = next((step for step in available_steps if step not in completed_steps_set), None)
+        if next_step is not None:
+            logger.info("➡️ Next step in sequence: %s", next_step)
+            return {
+                "current_step": next_step,
+                "required_tools": [],
+                "next_step_hint": None,
+                "workflow_complete": False
+            }
+    
+    # A no-tool step may already have named its successor; take it without another LLM call
+    next_step_hint = state.get("next_step_hint")
+    if next_step_hint in state["available_steps_set"] and next_step_hint not in completed_steps_set:
+        logger.info("⏭️ Hinted step selected: %s", next_step_hint)
+        return {
+            "current_step": next_step_hint,
+            "required_tools": [],
+            "next_step_hint": None,
+            "workflow_complete": False
+        }
+    
+    # Same SOP, same progress and same last tool outcome: reuse the earlier choice
+    step_cache_key = StepSelectionCache.key(
+        model, state["step_selection_system"], state["sop_workflow"], completed_steps, *last_tool_outcome(execution_memory)
+    )
+    cached_result = step_cache.get(step_cache_key) if LLM_CACHE_ENABLED else None
+    if cached_result is not None and cached_result["next_step"] not in completed_steps_set:
+        logger.info("🎯 Selected step (cached): %s", cached_result["next_step"])
+        return {
+            "current_step": cached_result["next_step"],
+            "required_tools": cached_result["required_tools"],
+            "next_step_hint": None,
+            "workflow_complete": False
+        }
+    
     # Use LLM to determine next step and required tools
     context_prompt = prompts.build_step_selection_prompt(
-        available_steps=available_steps,
         completed_steps=completed_steps,
         execution_memory=execution_memory
     )
     
+    check_context_budget(state["step_selection_system"], context_prompt)
+    
     try:
-        response = client.generate(model=model, prompt=context_prompt)
-        print("🔍 LLM Response: ", response["response"].strip())
-        match = re.search(r"\{.*\}", response["response"].strip(), re.DOTALL)
-        result = None
-        if match:
-            json_str = match.group(0)
-            try:
-                result = json.loads(json_str)
-            except json.JSONDecodeError as e:
-                print("Invalid JSON:", e)
-        else:
-            print("No JSON found")
-        next_step = result.get("next_step", "")
+        response = cached_client.generate(
+            model=model, prompt=context_prompt, system=state["step_selection_system"],
+            format=prompts.STEP_SELECTION_SCHEMA, options=LLM_OPTIONS,
+            # Routing only needs next_step and required_tools; stop before the trailing reasoning
+            stop_at_key="reasoning", required_keys=("next_step",), cache_salt="step_selection", cache=LLM_CACHE_ENABLED,
+            # Within a run the nearest earlier prompt is the previous step's, whose answer just completed
+            semantic=False
+        )
+        logger.debug("🔍 LLM Response: %s", response["response"])
+        result = orjson.loads(response["response"])
+        # A missing next_step is a malformed answer, not a finished workflow; KeyError takes the fallback
+        next_step = result["next_step"]
         required_tools = result.get("required_tools", [])
         reasoning = result.get("reasoning", "")
         
-        print(f"🎯 Selected step: {next_step}")
-        print(f"🔧 Required tools: {required_tools}")
-        print(f"💭 Reasoning: {reasoning}")
+        logger.info("🎯 Selected step: %s", next_step)
+        logger.debug("🔧 Required tools: %s", required_tools)
+        logger.debug("💭 Reasoning: %s", reasoning)
         
-        if next_step == "WORKFLOW_COMPLETE" or next_step not in available_steps:
+        if next_step == "WORKFLOW_COMPLETE" or next_step not in state["available_steps_set"]:
             return {
-                **state,
                 "workflow_complete": True
             }
+        # Never re-run a finished step, even if the model names one
+        if next_step in completed_steps_set:
+            raise ValueError(f"step already completed: {next_step}")
         
+        if LLM_CACHE_ENABLED:
+            step_cache.set(step_cache_key, {"next_step": next_step, "required_tools": required_tools})
         return {
-            **state,
             "current_step": next_step,
             "required_tools": required_tools,
+            "next_step_hint": None,
             "workflow_complete": False
         }
         
     except Exception as e:
-        print(f"❌ Error in step selection: {e}")
+        logger.error("❌ Error in step selection: %s", e)
         # Fallback to first uncompleted step
-        remaining_steps = [step for step in available_steps if step not in completed_steps]
+        remaining_steps = [step for step in available_steps if step not in completed_steps_set]
         if remaining_steps:
             return {
-                **state,
                 "current_step": remaining_steps[0],
                 "required_tools": [],
+                "next_step_hint": None,
                 "workflow_complete": False
             }
         else:
             return {
-                **state,
                 "workflow_complete": True
             }
 
 
 def llm_tool_execution_node(state: State):
     """Execute the current step using LLM with available tools"""
-    tools = LLMTools()
+    tools = llm_tools
     current_step = state["current_step"]
     execution_memory = state.get("execution_memory", [])
     user_context = state.get("user_context", {})
     
-    print(f"\n🤖 LLM TOOL EXECUTION for step: {current_step}")
+    logger.info("🤖 LLM TOOL EXECUTION for step: %s", current_step)
     
     # Create context for LLM
     context_prompt = prompts.build_tool_execution_prompt(
         current_step=current_step,
-        tools=tools,
         user_context=user_context,
-        execution_memory=execution_memory
+        execution_memory=execution_memory,
+        memory_summary=state.get("memory_summary", "")
     )
+    check_context_budget(state["tool_execution_system"], context_prompt)
     
     try:
-        response = client.generate(model=model, prompt=context_prompt)
-        print("🔍 LLM Response: ", response["response"].strip())
-        match = re.search(r"\{.*\}", response["response"].strip(), re.DOTALL)
-        llm_response = None
-        if match:
-            json_str = match.group(0)
-            try:
-                llm_response = json.loads(json_str)
-            except json.JSONDecodeError as e:
-                print("Invalid JSON:", e)
-        else:
-            print("No JSON found")        
-        print("LLM Response JSON TOOL EXECUTION:", llm_response)
+        # Exact matches only: a paraphrase hit would replay another step's side-effecting tool calls
+        response = cached_client.generate(
+            model=model, prompt=context_prompt, system=state["tool_execution_system"], semantic=False,
+            format=prompts.TOOL_EXECUTION_SCHEMA, options=LLM_OPTIONS,
+            cache_salt="tool_execution", cache=LLM_CACHE_ENABLED
+        )
+        logger.debug("🔍 LLM Response: %s", response["response"])
+        llm_response = orjson.loads(response["response"])
         tool_calls = llm_response.get("tool_calls", [])
         reasoning = llm_response.get("reasoning", "")
-        print(f"💭 LLM Reasoning: {reasoning}")
-        print(f"🔧 Tool Calls: {tool_calls}")
+        # Only trust the hint when no tools ran; otherwise it predates their results
+        next_step_hint = None if tool_calls else llm_response.get("next_step_hint")
+        logger.debug("💭 LLM Reasoning: %s", reasoning)
+        logger.debug("🔧 Tool Calls: %s", tool_calls)
         tool_results = []
         # Execute each tool call
-        print()
-        for tool_call in tool_calls:
-            tool_name = tool_call.get("tool_name")
-            parameters = tool_call.get("parameters", {})
+        for group in group_tool_calls(tool_calls):
+            if len(group) == 1:
+                results = [run_tool_call(tools, group[0])]
+            else:
+                results = list(tool_executor.map(lambda tc: run_tool_call(tools, tc), group))
             
-            print(f"🔧 Executing tool: {tool_name}")
-            result = tools.execute_tool(tool_name, parameters)
-            tool_results.append({
-                "tool_name": tool_name,
-                "parameters": parameters,
-                "result": result
-            })
-            
-            # Update user context with results
-            if tool_name == "ask_user_input" and result.get("success"):
-                user_context.update({
-                    "last_user_input": result.get("user_response"),
-                    "last_prompt": result.get("prompt_shown")
+            for tool_call, result in zip(group, results):
+                tool_name = tool_call.get("tool_name")
+                tool_results.append({
+                    "tool_name": tool_name,
+                    "parameters": tool_call.get("parameters", {}),
+                    "result": result
                 })
+                
+                # Update user context with results
+                if tool_name == "ask_user_input" and result.get("success"):
+                    user_context.update({
+                        "last_user_input": result.get("user_response"),
+                        "last_prompt": result.get("prompt_shown")
+                    })
         
         # Add to execution memory
-        # Add to execution memory
+        feedback = f"Completed using tools: {[tc['tool_name'] for tc in tool_calls]}"
         execution_entry = {
             "action": current_step,
             "observation": tool_results,
-            "feedback": f"Completed using tools: {[tc['tool_name'] for tc in tool_calls]}"
+            "feedback": feedback,
+            "rendered": prompts.render_memory_entry(current_step, tool_results, feedback)
         }
-        execution_memory.append(execution_entry)
+        memory_summary = record_memory(state, execution_entry)
 
-        print("\n🧠 Updated Execution Memory:")
-        pp.pprint(execution_memory)
+        # pformat walks the whole memory; skip it unless DEBUG output is on
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("🧠 Updated Execution Memory:\n%s", pp.pformat(execution_memory))
 
         
         # Mark step as completed
         completed_steps = state.get("completed_steps", [])
-        if current_step not in completed_steps:
+        completed_steps_set = state.get("completed_steps_set", set())
+        if current_step not in completed_steps_set:
             completed_steps.append(current_step)
+            completed_steps_set.add(current_step)
         
         return {
-            **state,
             "execution_memory": execution_memory,
+            "memory_summary": memory_summary,
             "completed_steps": completed_steps,
+            "completed_steps_set": completed_steps_set,
             "user_context": user_context,
+            "next_step_hint": next_step_hint,
             "tool_results": {
                 "last_execution": tool_results,
                 "reasoning": reasoning
@@ -230,23 +380,29 @@ def llm_tool_execution_node(state: State):
         }
         
     except Exception as e:
-        print(f"❌ Error in LLM tool execution: {e}")
+        logger.error("❌ Error in LLM tool execution: %s", e)
         
         # Fallback - mark step as completed with error
-        execution_memory.append({
+        observation = f"Error: {str(e)}"
+        memory_summary = record_memory(state, {
             "action": current_step,
-            "observation": f"Error: {str(e)}",
-            "feedback": "completed_with_error"
+            "observation": observation,
+            "feedback": "completed_with_error",
+            "rendered": prompts.render_memory_entry(current_step, observation, "completed_with_error")
         })
         
         completed_steps = state.get("completed_steps", [])
-        if current_step not in completed_steps:
+        completed_steps_set = state.get("completed_steps_set", set())
+        if current_step not in completed_steps_set:
             completed_steps.append(current_step)
+            completed_steps_set.add(current_step)
         
         return {
-            **state,
             "execution_memory": execution_memory,
-            "completed_steps": completed_steps
+            "memory_summary": memory_summary,
+            "completed_steps": completed_steps,
+            "completed_steps_set": completed_steps_set,
+            "next_step_hint": None
         }
 
 # ===================
@@ -283,25 +439,57 @@ def build_workflow():
 # MAIN EXECUTION
 # ===================
 
+def configure_logging():
+    """Send log records to stdout through one buffered handler; SOP_VERBOSE=1 enables DEBUG"""
+    verbose = os.environ.get("SOP_VERBOSE", "").lower() in ("1", "true", "yes")
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(message)s"))
+    buffered_handler = logging.handlers.MemoryHandler(
+        LOG_BUFFER_RECORDS, flushLevel=logging.WARNING, target=stream_handler
+    )
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO, handlers=[buffered_handler])
+    return buffered_handler
+
+
+def warm_up_model():
+    """Load the model before the first workflow step so it doesn't pay the load time"""
+    try:
+        client.generate(model=model, prompt="ok", options={**LLM_OPTIONS, "num_predict": 1})
+    except Exception as e:
+        logger.warning("⚠️ Model warm-up failed: %s", e)
+
+
 def main():
     """Main execution function"""
+    log_handler = configure_logging()
+
     # Sample SOP workflow
     sop_content = drive_access.sop_content.strip()
+    available_steps = parse_sop_steps(sop_content)
+    available_steps_rendered = prompts.render_available_steps(available_steps)
     
-    print("🚀 Starting LLM Tools Workflow...\n")
+    logger.info("🚀 Starting LLM Tools Workflow...")
     
     initial_state = {
         "sop_workflow": sop_content,
-        "execution_memory": [],
+        "execution_memory": deque(maxlen=MAX_EXECUTION_MEMORY),
+        "memory_summary": "",
         "global_action_repository": drive_gar,
-        "available_steps": [],
+        "available_steps": available_steps,
+        "available_steps_set": set(available_steps),
+        "step_selection_system": prompts.build_step_selection_system(available_steps_rendered),
+        "tool_execution_system": prompts.build_tool_execution_system(available_steps_rendered),
+        "sop_is_linear": is_linear_sop(sop_content),
         "completed_steps": [],
+        "completed_steps_set": set(),
         "workflow_complete": False,
         "tool_results": {},
-        "user_context": {}
+        "user_context": {},
+        "next_step_hint": None
     }
     
     # Build and run workflow
+    warm_up_model()
     chain = build_workflow()
     config = {"recursion_limit": 20}
     
@@ -309,24 +497,22 @@ def main():
         for event in chain.stream(initial_state, config=config):
             if isinstance(event, dict):
                 for key, value in event.items():
-                    print(f"\n{'='*50}")
-                    print(f"📍 Node: '{key}'")
-                    print(f"{'='*50}")
+                    logger.info("📍 Node: '%s'", key)
                     
-                    # Print key state information
+                    # Log key state information
                     if "current_step" in value:
-                        print(f"🎯 Current Step: {value['current_step']}")
+                        logger.debug("🎯 Current Step: %s", value["current_step"])
                     if "completed_steps" in value:
-                        print(f"✅ Completed Steps: {len(value['completed_steps'])}")
+                        logger.debug("✅ Completed Steps: %d", len(value["completed_steps"]))
                     if "workflow_complete" in value:
-                        print(f"🏁 Workflow Complete: {value['workflow_complete']}")
-                    
-                    print()
+                        logger.debug("🏁 Workflow Complete: %s", value["workflow_complete"])
         
-        print("\n🎉 Workflow completed successfully!")
+        logger.info("🎉 Workflow completed successfully!")
         
     except Exception as e:
-        print(f"❌ Workflow execution error: {e}")
+        logger.error("❌ Workflow execution error: %s", e)
+    finally:
+        log_handler.flush()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
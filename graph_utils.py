@@ -1,10 +1,456 @@
 from datetime import datetime
+import hashlib
+import itertools
+import json
+import logging
+import re
+import shelve
+import sqlite3
+import time
+import unicodedata
+from collections import OrderedDict
 import numpy as np
+import orjson
 import ollama
-from typing import Dict, List
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
 
 client = ollama.Client()
-embedding_model = "deepseek-r1:8b"
+# Small dedicated embedding model; generative models stay in graph.py
+embedding_model = "nomic-embed-text"
+
+_REQUEST_ID_RE = re.compile(r'/requests/(\d+)')
+
+
+def get_embedding(text: str) -> np.ndarray:
+    """Embed text with the configured embedding model, scaled to unit length"""
+    response = client.embeddings(model=embedding_model, prompt=text)
+    vec = np.asarray(response["embedding"], dtype=np.float32)
+    return vec / (np.linalg.norm(vec) or 1.0)
+
+
+def normalize_prompt(prompt: str) -> str:
+    """NFC-normalize and collapse whitespace so equivalent prompts share a cache key"""
+    return " ".join(unicodedata.normalize("NFC", prompt).split())
+
+
+def json_until_key(chunks: Iterable[Any], stop_key: str, required_keys: Tuple[str, ...] = ()) -> str:
+    """Read a streamed JSON object until stop_key begins and return the object closed before it"""
+    marker = f'"{stop_key}"'
+    text = ""
+    search_from = 0
+    stream = iter(chunks)
+    try:
+        for chunk in stream:
+            text += chunk["response"]
+            cut = text.find(marker, search_from)
+            while cut != -1:
+                head = text[:cut].rstrip().rstrip(",") + "}"
+                try:
+                    parsed = orjson.loads(head)
+                except ValueError:
+                    # The marker sits inside an earlier string value; keep reading
+                    search_from = cut + 1
+                    cut = text.find(marker, search_from)
+                    continue
+                if all(key in parsed for key in required_keys):
+                    return head
+                # stop_key came before fields the caller needs; only the full object has them
+                return text + "".join(chunk["response"] for chunk in stream)
+        return text
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+class EmbeddingIndex:
+    """Growable float32 embedding matrix for batched cosine-similarity lookups"""
+
+    def __init__(self, dim: int, capacity: int = 64):
+        self.keys: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.mat = np.empty((capacity, dim), dtype=np.float32)
+        self.norms = np.empty(capacity, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def add(self, key: str, vec: np.ndarray) -> None:
+        n = len(self.keys)
+        if n == self.mat.shape[0]:
+            self.mat = np.concatenate([self.mat, np.empty_like(self.mat)])
+            self.norms = np.concatenate([self.norms, np.empty_like(self.norms)])
+        self.mat[n] = vec
+        self.norms[n] = np.linalg.norm(vec)
+        self.keys.append(key)
+        self.rows[key] = n
+
+    def remove(self, key: str) -> None:
+        """Drop key's row by moving the last row into its place"""
+        i = self.rows.pop(key, None)
+        if i is None:
+            return
+        last = len(self.keys) - 1
+        if i != last:
+            self.mat[i] = self.mat[last]
+            self.norms[i] = self.norms[last]
+            self.keys[i] = self.keys[last]
+            self.rows[self.keys[i]] = i
+        self.keys.pop()
+
+    def topk(self, query: np.ndarray, k: int) -> List[Tuple[str, float]]:
+        """The k most similar keys with their cosine similarities, best first"""
+        n = len(self.keys)
+        k = min(k, n)
+        if k == 0:
+            return []
+        sims = (self.mat[:n] @ query) / (self.norms[:n] * np.linalg.norm(query) + 1e-10)
+        best = np.argpartition(-sims, k - 1)[:k]
+        best = best[np.argsort(-sims[best])]
+        return [(self.keys[i], float(sims[i])) for i in best]
+
+
+class LLMBackend:
+    """generate()-compatible client for an OpenAI-compatible server such as vLLM"""
+
+    def __init__(self, base_url: str, api_key: str = "none", max_tokens: int = 512):
+        from openai import OpenAI
+
+        self.client = OpenAI(base_url=base_url, api_key=api_key)
+        self.max_tokens = max_tokens
+
+    def generate(self, model: str, prompt: str, system: Optional[str] = None, format: Any = None, options: Optional[Dict] = None, **kwargs) -> Dict[str, str]:
+        options = options or {}
+        stream = kwargs.get("stream", False)
+        if isinstance(format, dict):
+            extra = {"response_format": {"type": "json_schema", "json_schema": {"name": "response", "schema": format}}}
+        elif format == "json":
+            extra = {"response_format": {"type": "json_object"}}
+        else:
+            extra = {}
+        completion = self.client.chat.completions.create(
+            model=model,
+            # The system message is the stable prefix the server's prefix cache reuses
+            messages=([{"role": "system", "content": system}] if system else []) + [{"role": "user", "content": prompt}],
+            temperature=options.get("temperature", 0),
+            max_tokens=options.get("num_predict", self.max_tokens),
+            stream=stream,
+            **extra,
+        )
+        if stream:
+            return self._stream_chunks(completion)
+        return {"response": completion.choices[0].message.content or ""}
+
+    @staticmethod
+    def _stream_chunks(completion: Any) -> Iterator[Dict[str, str]]:
+        try:
+            for chunk in completion:
+                if chunk.choices:
+                    yield {"response": chunk.choices[0].delta.content or ""}
+        finally:
+            # Closing the generator early (json_until_key) also drops the HTTP stream
+            completion.close()
+
+
+class CachedOllamaClient:
+    """Two-level response cache (exact, then semantic) in front of a client's generate()"""
+
+    def __init__(self, client: Any, similarity_threshold: float = 0.97, persist_path: Optional[str] = None, max_entries: int = 4096):
+        self.client = client
+        self.similarity_threshold = similarity_threshold
+        self.persist_path = persist_path
+        self.max_entries = max_entries
+        self._conn: Optional[sqlite3.Connection] = None
+        self._exact: "OrderedDict[str, Any]" = OrderedDict()
+        # Per-namespace L2 index over L1 keys; a key leaves its index when L1 evicts it
+        self._semantic: Dict[str, EmbeddingIndex] = {}
+        self._semantic_namespace: Dict[str, str] = {}
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.persist_path)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache "
+                "(key TEXT PRIMARY KEY, model TEXT, response TEXT, created_at REAL)"
+            )
+        return self._conn
+
+    def _load_persisted(self, key: str) -> Optional[Dict[str, str]]:
+        row = self._db().execute("SELECT response FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        return {"response": row[0]} if row else None
+
+    def _persist(self, key: str, model: str, response: Any) -> None:
+        with self._db() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, model, response, created_at) VALUES (?, ?, ?, ?)",
+                (key, model, response["response"], time.time()),
+            )
+
+    def _get_exact(self, key: str) -> Any:
+        cached = self._exact.get(key)
+        if cached is not None:
+            self._exact.move_to_end(key)
+        return cached
+
+    def _put_exact(self, key: str, response: Any) -> None:
+        self._exact[key] = response
+        self._exact.move_to_end(key)
+        if len(self._exact) > self.max_entries:
+            evicted, _ = self._exact.popitem(last=False)
+            namespace = self._semantic_namespace.pop(evicted, None)
+            if namespace is not None:
+                self._semantic[namespace].remove(evicted)
+
+    def _call(self, model: str, prompt: str, stop_at_key: Optional[str], required_keys: Tuple[str, ...], kwargs: Dict[str, Any]) -> Any:
+        if stop_at_key:
+            stream = self.client.generate(model=model, prompt=prompt, stream=True, **kwargs)
+            return {"response": json_until_key(stream, stop_at_key, required_keys)}
+        return self.client.generate(model=model, prompt=prompt, **kwargs)
+
+    def generate(self, model: str, prompt: str, semantic: bool = True, stop_at_key: Optional[str] = None, required_keys: Tuple[str, ...] = (), cache_salt: str = "", cache: bool = True, **kwargs) -> Any:
+        """Drop-in for client.generate(); semantic=False restricts lookups to exact matches"""
+        if not cache or (kwargs.get("options") or {}).get("temperature") != 0:
+            return self._call(model, prompt, stop_at_key, required_keys, kwargs)
+
+        namespace = f"{model}\0{cache_salt}\0{stop_at_key}\0{required_keys}\0{json.dumps(kwargs, sort_keys=True, default=str)}"
+        normalized = normalize_prompt(prompt)
+        key = hashlib.sha256(f"{namespace}\0{normalized}".encode()).hexdigest()
+
+        cached = self._get_exact(key)
+        if cached is None and self.persist_path:
+            cached = self._load_persisted(key)
+            if cached is not None:
+                self._put_exact(key, cached)
+        if cached is not None:
+            logger.debug("♻️ LLM cache hit (exact): %s", cache_salt or model)
+            return cached
+
+        query = None
+        if semantic:
+            try:
+                query = get_embedding(normalized)
+            except Exception as e:
+                # An unreachable or missing embedding model only costs the L2 lookup
+                logger.warning("⚠️ Embedding failed, skipping semantic cache: %s", e)
+        if query is not None:
+            index = self._semantic.get(namespace)
+            if index is not None:
+                hits = index.topk(query, 1)
+                if hits and hits[0][1] >= self.similarity_threshold:
+                    cached = self._get_exact(hits[0][0])
+                    if cached is not None:
+                        logger.debug("♻️ LLM cache hit (semantic, %.3f): %s", hits[0][1], cache_salt or model)
+                        return cached
+
+        response = self._call(model, prompt, stop_at_key, required_keys, kwargs)
+        self._put_exact(key, response)
+        if self.persist_path:
+            self._persist(key, model, response)
+        if query is not None:
+            self._semantic.setdefault(namespace, EmbeddingIndex(query.shape[0])).add(key, query)
+            self._semantic_namespace[key] = namespace
+        return response
+
+
+class StepSelectionCache:
+    """Persistent cache of step-selection results, stored with shelve"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._shelf: Optional[shelve.Shelf] = None
+
+    def _db(self) -> shelve.Shelf:
+        if self._shelf is None:
+            self._shelf = shelve.open(self.path)
+        return self._shelf
+
+    @staticmethod
+    def key(model: str, system: str, sop_workflow: str, completed_steps: List[str], last_tool_name: Optional[str], last_tool_success: Optional[bool]) -> str:
+        # A different model or system prompt can pick a different step
+        system_hash = hashlib.sha256(system.encode()).hexdigest()
+        payload = json.dumps([model, system_hash, sop_workflow, completed_steps, last_tool_name, last_tool_success])
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self._db().get(key)
+
+    def set(self, key: str, result: Dict[str, Any]) -> None:
+        db = self._db()
+        db[key] = result
+        db.sync()
+
+
+TOOL_DEFINITIONS: Tuple[Dict, ...] = (
+    {
+        "type": "function",
+        "function": {
+            "name": "ask_user_input",
+            "description": "Ask the user for input with a specific prompt",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "prompt": {"type": "string", "description": "The question/prompt to show the user"},
+                    "context": {"type": "string", "description": "Additional context about what input is needed"}
+                },
+                "required": ["prompt"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "show_message_to_user",
+            "description": "Display a message to the user",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "message": {"type": "string", "description": "The message to display"},
+                    "message_type": {"type": "string", "enum": ["info", "success", "warning", "error"], "description": "Type of message"}
+                },
+                "required": ["message"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "api_call",
+            "description": "Make an API call to retrieve or update data",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "endpoint": {"type": "string", "description": "API endpoint to call"},
+                    "method": {"type": "string", "enum": ["GET", "POST", "PUT", "DELETE"], "description": "HTTP method"},
+                    "params": {"type": "object", "description": "Parameters for the API call"},
+                    "purpose": {"type": "string", "description": "Purpose of the API call"}
+                },
+                "required": ["endpoint", "method"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "create_ticket",
+            "description": "Create a support ticket",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "title": {"type": "string", "description": "Ticket title"},
+                    "description": {"type": "string", "description": "Detailed description of the issue"},
+                    "priority": {"type": "string", "enum": ["low", "medium", "high", "urgent"], "description": "Ticket priority"},
+                    "request_id": {"type": "integer", "description": "Related request ID"}
+                },
+                "required": ["title", "description"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "send_notification",
+            "description": "Send a notification to a user",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "recipient": {"type": "string", "description": "Email address of recipient"},
+                    "subject": {"type": "string", "description": "Email subject"},
+                    "message": {"type": "string", "description": "Email message body"},
+                    "request_id": {"type": "integer", "description": "Related request ID"}
+                },
+                "required": ["recipient", "subject", "message"]
+            }
+        }
+    }
+)
+
+# Serialized once with sorted keys; the catalog is static and is embedded in every
+# tool-execution prompt, so its text must stay byte-identical across calls. Compact
+# separators: the model doesn't need the indentation and it costs tokens.
+TOOL_DEFINITIONS_JSON = json.dumps(TOOL_DEFINITIONS, sort_keys=True, separators=(",", ":"))
+
+
+# Tool call classes: INFORMATIONAL calls are side-effect free and their results
+# may be reused; COMMAND calls mutate state and must always run.
+INFORMATIONAL = "INFO"
+COMMAND = "CMD"
+
+_TOOL_CLASS = {
+    "ask_user_input": INFORMATIONAL,
+    "show_message_to_user": COMMAND,
+    "create_ticket": COMMAND,
+    "send_notification": COMMAND,
+}
+
+
+def classify_tool_call(tool_name: str, parameters: Dict) -> str:
+    """Return INFORMATIONAL or COMMAND for a tool call; unknown tools are COMMAND"""
+    if tool_name == "api_call":
+        return INFORMATIONAL if str(parameters.get("method", "GET")).upper() == "GET" else COMMAND
+    return _TOOL_CLASS.get(tool_name, COMMAND)
+
+
+# Enum-like parameters compared case-insensitively when building cache keys
+_LOWERCASE_PARAMS = ("message_type", "priority")
+
+
+def _canonical_value(value: Any) -> Any:
+    """NFC-normalize strings and round floats, recursing into containers"""
+    if isinstance(value, str):
+        return unicodedata.normalize("NFC", value)
+    if isinstance(value, float):
+        return round(value, 6)
+    if isinstance(value, dict):
+        return {str(k): _canonical_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical_value(v) for v in value]
+    return value
+
+
+def _canonical_params(p: Dict) -> str:
+    """Serialize tool parameters so semantically equal calls produce the same string"""
+    canonical = _canonical_value(p)
+    for field in _LOWERCASE_PARAMS:
+        if isinstance(canonical.get(field), str):
+            canonical[field] = canonical[field].lower()
+    if isinstance(canonical.get("method"), str):
+        canonical["method"] = canonical["method"].upper()
+    if isinstance(canonical.get("endpoint"), str):
+        canonical["endpoint"] = canonical["endpoint"].rstrip("/")
+    return orjson.dumps(canonical, option=orjson.OPT_SORT_KEYS, default=str).decode()
+
+
+# Keyword tables for the simulated user, checked in order. Every keyword in an
+# entry must appear in the lowercased text for that entry to match.
+_PROMPT_KEYWORDS: Tuple[Tuple[Tuple[str, ...], str], ...] = (
+    (("request id",), "102"),
+    (("request_id",), "102"),
+    (("email",), "user@company.com"),
+    (("reason",), "Need access for Q4 budget analysis project"),
+    (("manager",), "manager@company.com"),
+    (("confirm",), "Yes, I confirm"),
+    (("approve",), "Yes, I confirm"),
+    (("priority",), "high"),
+)
+
+_ACK_KEYWORDS: Tuple[Tuple[Tuple[str, ...], str], ...] = (
+    (("approved",), "Great! Thank you for the approval."),
+    (("ticket", "created"), "Thank you for creating the ticket."),
+    (("processing",), "Understood. I'll wait for the process to complete."),
+    (("error",), "I see there's an issue. What should I do next?"),
+)
+
+
+# Icons for show_message_to_user, keyed by message_type
+_MSG_ICONS = {"info": "ℹ️", "success": "✅", "warning": "⚠️", "error": "❌"}
+_DEFAULT_ICON = "📢"
+
+
+def _first_keyword_match(text_lower: str, table: Tuple[Tuple[Tuple[str, ...], str], ...], default: str) -> str:
+    """Return the response of the first table entry whose keywords all occur in text_lower"""
+    return next((response for keywords, response in table if all(k in text_lower for k in keywords)), default)
 
 
 class LLMTools:
@@ -19,159 +465,90 @@ class LLMTools:
         }
         self.mock_tickets = []
         self.mock_notifications = []
+        self._ticket_ids = itertools.count(1)
+        self._notification_ids = itertools.count(1)
+        self._tool_cache: Dict[Tuple[str, str], Dict] = {}
+        self._dispatch = {
+            "ask_user_input": self._ask_user_input,
+            "show_message_to_user": self._show_message_to_user,
+            "api_call": self._api_call,
+            "create_ticket": self._create_ticket,
+            "send_notification": self._send_notification,
+        }
     
-    def get_tool_definitions(self) -> List[Dict]:
+    def get_tool_definitions(self) -> Tuple[Dict, ...]:
         """Return tool definitions for LLM"""
-        return [
-            {
-                "type": "function",
-                "function": {
-                    "name": "ask_user_input",
-                    "description": "Ask the user for input with a specific prompt",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "prompt": {"type": "string", "description": "The question/prompt to show the user"},
-                            "context": {"type": "string", "description": "Additional context about what input is needed"}
-                        },
-                        "required": ["prompt"]
-                    }
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "show_message_to_user",
-                    "description": "Display a message to the user",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "message": {"type": "string", "description": "The message to display"},
-                            "message_type": {"type": "string", "enum": ["info", "success", "warning", "error"], "description": "Type of message"}
-                        },
-                        "required": ["message"]
-                    }
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "api_call",
-                    "description": "Make an API call to retrieve or update data",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "endpoint": {"type": "string", "description": "API endpoint to call"},
-                            "method": {"type": "string", "enum": ["GET", "POST", "PUT", "DELETE"], "description": "HTTP method"},
-                            "params": {"type": "object", "description": "Parameters for the API call"},
-                            "purpose": {"type": "string", "description": "Purpose of the API call"}
-                        },
-                        "required": ["endpoint", "method"]
-                    }
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "create_ticket",
-                    "description": "Create a support ticket",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "title": {"type": "string", "description": "Ticket title"},
-                            "description": {"type": "string", "description": "Detailed description of the issue"},
-                            "priority": {"type": "string", "enum": ["low", "medium", "high", "urgent"], "description": "Ticket priority"},
-                            "request_id": {"type": "integer", "description": "Related request ID"}
-                        },
-                        "required": ["title", "description"]
-                    }
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "send_notification",
-                    "description": "Send a notification to a user",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "recipient": {"type": "string", "description": "Email address of recipient"},
-                            "subject": {"type": "string", "description": "Email subject"},
-                            "message": {"type": "string", "description": "Email message body"},
-                            "request_id": {"type": "integer", "description": "Related request ID"}
-                        },
-                        "required": ["recipient", "subject", "message"]
-                    }
-                }
-            }
-        ]
+        return TOOL_DEFINITIONS
     
     def execute_tool(self, tool_name: str, parameters: Dict) -> Dict:
-        """Execute a specific tool with given parameters"""
-        if tool_name == "ask_user_input":
-            return self._ask_user_input(parameters)
-        elif tool_name == "show_message_to_user":
-            return self._show_message_to_user(parameters)
-        elif tool_name == "api_call":
-            return self._api_call(parameters)
-        elif tool_name == "create_ticket":
-            return self._create_ticket(parameters)
-        elif tool_name == "send_notification":
-            return self._send_notification(parameters)
-        else:
-            return {"error": f"Unknown tool: {tool_name}"}
+        """Execute a specific tool with given parameters, reusing results of informational calls"""
+        # One timestamp per call, shared by whatever the handler records; kept local
+        # because the tool executor runs calls on several threads
+        now = datetime.now().isoformat(timespec="seconds")
+        if classify_tool_call(tool_name, parameters) != INFORMATIONAL:
+            return self._dispatch_tool(tool_name, parameters, now)
+
+        key = (tool_name, _canonical_params(parameters))
+        if key not in self._tool_cache:
+            self._tool_cache[key] = self._dispatch_tool(tool_name, parameters, now)
+        return self._tool_cache[key]
     
-    def _ask_user_input(self, params: Dict) -> Dict:
+    def _dispatch_tool(self, tool_name: str, parameters: Dict, now: str) -> Dict:
+        """Route a tool call to its handler"""
+        handler = self._dispatch.get(tool_name)
+        return handler(parameters, now) if handler else {"error": f"Unknown tool: {tool_name}"}
+    
+    def _ask_user_input(self, params: Dict, now: str) -> Dict:
         """Mock user input collection"""
         prompt = params.get("prompt", "No prompt provided")
         context = params.get("context", "")
         
-        print(f"\n🤖 USER INPUT REQUEST: {prompt}")
+        logger.info("🤖 USER INPUT REQUEST: %s", prompt)
         if context:
-            print(f"📝 Context: {context}")
+            logger.debug("📝 Context: %s", context)
         
         # Generate realistic mock response based on prompt content
         mock_response = self._generate_mock_user_response(prompt)
-        print(f"👤 SIMULATED USER RESPONSE: {mock_response}")
+        logger.info("👤 SIMULATED USER RESPONSE: %s", mock_response)
         
         return {
             "success": True,
             "user_response": mock_response,
             "prompt_shown": prompt,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": now
         }
     
-    def _show_message_to_user(self, params: Dict) -> Dict:
+    def _show_message_to_user(self, params: Dict, now: str) -> Dict:
         """Mock message display"""
         message = params.get("message", "No message provided")
         message_type = params.get("message_type", "info")
         
-        icon = {"info": "ℹ️", "success": "✅", "warning": "⚠️", "error": "❌"}.get(message_type, "📢")
-        print(f"\n{icon} MESSAGE TO USER: {message}")
+        icon = _MSG_ICONS.get(message_type, _DEFAULT_ICON)
+        logger.info("%s MESSAGE TO USER: %s", icon, message)
         
         # Generate user acknowledgment
         acknowledgment = self._generate_user_acknowledgment(message)
-        print(f"👤 USER ACKNOWLEDGMENT: {acknowledgment}")
+        logger.info("👤 USER ACKNOWLEDGMENT: %s", acknowledgment)
         
         return {
             "success": True,
             "message_displayed": message,
             "message_type": message_type,
             "user_acknowledgment": acknowledgment,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": now
         }
     
-    def _api_call(self, params: Dict) -> Dict:
+    def _api_call(self, params: Dict, now: str) -> Dict:
         """Mock API calls"""
         endpoint = params.get("endpoint", "")
         method = params.get("method", "GET")
         api_params = params.get("params", {})
         purpose = params.get("purpose", "")
         
-        print(f"\n🔗 API CALL: {method} {endpoint}")
-        print(f"📝 Parameters: {api_params}")
+        logger.info("🔗 API CALL: %s %s", method, endpoint)
+        logger.debug("📝 Parameters: %s", api_params)
         if purpose:
-            print(f"🎯 Purpose: {purpose}")
+            logger.debug("🎯 Purpose: %s", purpose)
         
         # Mock different API endpoints
         if "/requests/" in endpoint:
@@ -181,14 +558,14 @@ class LLMTools:
         else:
             return {"error": "Unknown API endpoint", "endpoint": endpoint}
     
-    def _create_ticket(self, params: Dict) -> Dict:
+    def _create_ticket(self, params: Dict, now: str) -> Dict:
         """Mock ticket creation"""
         title = params.get("title", "No title")
         description = params.get("description", "No description")
         priority = params.get("priority", "medium")
         request_id = params.get("request_id")
         
-        ticket_id = len(self.mock_tickets) + 1
+        ticket_id = next(self._ticket_ids)
         ticket = {
             "ticket_id": ticket_id,
             "title": title,
@@ -196,13 +573,13 @@ class LLMTools:
             "priority": priority,
             "request_id": request_id,
             "status": "open",
-            "created_at": datetime.now().isoformat()
+            "created_at": now
         }
         self.mock_tickets.append(ticket)
         
-        print(f"\n🎫 TICKET CREATED: #{ticket_id} - {title}")
-        print(f"📋 Description: {description}")
-        print(f"⚡ Priority: {priority}")
+        logger.info("🎫 TICKET CREATED: #%s - %s", ticket_id, title)
+        logger.debug("📋 Description: %s", description)
+        logger.debug("⚡ Priority: %s", priority)
         
         return {
             "success": True,
@@ -210,7 +587,7 @@ class LLMTools:
             "message": f"Ticket #{ticket_id} created successfully"
         }
     
-    def _send_notification(self, params: Dict) -> Dict:
+    def _send_notification(self, params: Dict, now: str) -> Dict:
         """Mock notification sending"""
         recipient = params.get("recipient", "")
         subject = params.get("subject", "")
@@ -218,19 +595,19 @@ class LLMTools:
         request_id = params.get("request_id")
         
         notification = {
-            "id": len(self.mock_notifications) + 1,
+            "id": next(self._notification_ids),
             "recipient": recipient,
             "subject": subject,
             "message": message,
             "request_id": request_id,
-            "sent_at": datetime.now().isoformat(),
+            "sent_at": now,
             "status": "sent"
         }
         self.mock_notifications.append(notification)
         
-        print(f"\n📧 NOTIFICATION SENT TO: {recipient}")
-        print(f"📨 Subject: {subject}")
-        print(f"💬 Message: {message}")
+        logger.info("📧 NOTIFICATION SENT TO: %s", recipient)
+        logger.debug("📨 Subject: %s", subject)
+        logger.debug("💬 Message: %s", message)
         
         return {
             "success": True,
@@ -245,20 +622,19 @@ class LLMTools:
             request_id = params.get("request_id")
             if not request_id:
                 # Try to extract from endpoint
-                import re
-                match = re.search(r'/requests/(\d+)', endpoint)
+                match = _REQUEST_ID_RE.search(endpoint)
                 if match:
                     request_id = int(match.group(1))
             
-            if request_id and request_id in self.mock_requests_db:
-                request_data = self.mock_requests_db[request_id]
-                print(f"✅ REQUEST FOUND: {request_data}")
+            request_data = self.mock_requests_db.get(request_id) if request_id else None
+            if request_data is not None:
+                logger.debug("✅ REQUEST FOUND: %s", request_data)
                 return {
                     "success": True,
                     "request": request_data
                 }
             else:
-                print(f"❌ REQUEST NOT FOUND: {request_id}")
+                logger.debug("❌ REQUEST NOT FOUND: %s", request_id)
                 return {
                     "success": False,
                     "error": "Request not found",
@@ -278,34 +654,8 @@ class LLMTools:
     
     def _generate_mock_user_response(self, prompt: str) -> str:
         """Generate realistic user responses based on prompt"""
-        prompt_lower = prompt.lower()
-        
-        if "request id" in prompt_lower or "request_id" in prompt_lower:
-            return "102"
-        elif "email" in prompt_lower:
-            return "user@company.com"
-        elif "reason" in prompt_lower:
-            return "Need access for Q4 budget analysis project"
-        elif "manager" in prompt_lower:
-            return "manager@company.com"
-        elif "confirm" in prompt_lower or "approve" in prompt_lower:
-            return "Yes, I confirm"
-        elif "priority" in prompt_lower:
-            return "high"
-        else:
-            return "Please proceed with the next step"
+        return _first_keyword_match(prompt.lower(), _PROMPT_KEYWORDS, "Please proceed with the next step")
     
     def _generate_user_acknowledgment(self, message: str) -> str:
         """Generate user acknowledgment based on message"""
-        message_lower = message.lower()
-        
-        if "approved" in message_lower:
-            return "Great! Thank you for the approval."
-        elif "ticket" in message_lower and "created" in message_lower:
-            return "Thank you for creating the ticket."
-        elif "processing" in message_lower:
-            return "Understood. I'll wait for the process to complete."
-        elif "error" in message_lower:
-            return "I see there's an issue. What should I do next?"
-        else:
-            return "Acknowledged. Thank you for the information."
\ No newline at end of file
+        return _first_keyword_match(message.lower(), _ACK_KEYWORDS, "Acknowledged. Thank you for the information.")
\ No newline at end of file
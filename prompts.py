@@ -1,31 +1,121 @@
-import json
-from typing import Any, Dict, List
+import orjson
+from itertools import groupby, islice
+from typing import Any, Deque, Dict, Iterable, List
 
 from graph import ExecutionMemoryDict
-from graph_utils import LLMTools
+from graph_utils import TOOL_DEFINITIONS_JSON
 
+_NL = "\n"
 
-def build_step_selection_prompt(available_steps: List[str], completed_steps: List[str], execution_memory: List[ExecutionMemoryDict]) -> str:
-    return f"""
-You are managing a workflow execution. Analyze the current state and determine:
-1. The next step to execute
-2. What tools you need to use for that step
+RECENT_MEMORY_ENTRIES = 3
+MAX_FEEDBACK_CHARS = 200
+MAX_OBSERVATION_CHARS = 500
 
-Available SOP Steps:
-{chr(10).join([f"{i+1}. {step}" for i, step in enumerate(available_steps)])}
+# Llama-style tokenizers average ~4 chars/token on prose but fewer on compact
+# JSON; 3 errs toward overestimating so the context-budget warning fires early
+CHARS_PER_TOKEN = 3
 
-Completed Steps:
-{chr(10).join([f"- {step}" for step in completed_steps])}
 
-Recent Execution Memory:
-{chr(10).join([f"- {mem['action']}: {mem['feedback']}" for mem in execution_memory[-3:]])}
+def estimate_tokens(*texts: str) -> int:
+    """Cheap, deliberately high token estimate, without running a tokenizer"""
+    return sum(-(-len(text) // CHARS_PER_TOKEN) for text in texts)
 
-Available Tools:
+
+def _truncate(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def recent_memory(execution_memory: Deque[ExecutionMemoryDict], n: int = RECENT_MEMORY_ENTRIES) -> List[ExecutionMemoryDict]:
+    """Last n execution memory entries (deques do not support slicing)"""
+    return list(islice(execution_memory, max(0, len(execution_memory) - n), None))
+
+
+def _fmt_kv(d: Dict[str, Any], prefix: str = "") -> str:
+    """Render a dict as sorted 'key: value' lines, nesting dicts by indentation; far fewer tokens than JSON"""
+    lines = []
+    for key in sorted(d):
+        value = d[key]
+        if isinstance(value, dict) and value:
+            lines.append(f"{prefix}{key}:")
+            lines.append(_fmt_kv(value, prefix + "  "))
+        else:
+            lines.append(f"{prefix}{key}: {value}")
+    return _NL.join(lines)
+
+
+def _dedup_runs(lines: Iterable[str]) -> List[str]:
+    """Collapse consecutive identical lines (e.g. a retried failing step) into one tagged (xN)"""
+    collapsed = []
+    for line, run in groupby(lines):
+        count = sum(1 for _ in run)
+        collapsed.append(line if count == 1 else f"{line} (x{count})")
+    return collapsed
+
+
+def _project_mem(execution_memory: Deque[ExecutionMemoryDict], n: int = RECENT_MEMORY_ENTRIES) -> List[Dict[str, str]]:
+    """Action and truncated feedback of the last n entries; observations are left out"""
+    return [
+        {"action": mem["action"], "feedback": _truncate(mem["feedback"], MAX_FEEDBACK_CHARS)}
+        for mem in recent_memory(execution_memory, n)
+    ]
+
+
+# Per-call stamps; leaving them out keeps rendered prompts identical across runs so they stay cacheable
+_VOLATILE_FIELDS = frozenset(("timestamp", "created_at", "sent_at"))
+
+
+def _strip_volatile(value: Any) -> Any:
+    """Drop _VOLATILE_FIELDS from nested tool results"""
+    if isinstance(value, dict):
+        return {k: _strip_volatile(v) for k, v in value.items() if k not in _VOLATILE_FIELDS}
+    if isinstance(value, list):
+        return [_strip_volatile(v) for v in value]
+    return value
+
+
+def render_memory_entry(action: str, observation: Any, feedback: str) -> str:
+    """Render an execution memory entry once, when it is recorded, for reuse in prompts"""
+    observation_text = observation if isinstance(observation, str) else orjson.dumps(_strip_volatile(observation), default=str).decode()
+    return (
+        f"- {action}: {_truncate(feedback, MAX_FEEDBACK_CHARS)}\n"
+        f"  observation: {_truncate(observation_text, MAX_OBSERVATION_CHARS)}"
+    )
+
+
+def fold_into_summary(memory_summary: str, entry: ExecutionMemoryDict) -> str:
+    """Add a one-line trace of an entry that has left the recent-memory window"""
+    status = "error" if entry["feedback"] == "completed_with_error" else "done"
+    line = f"- {entry['action']} ({status})"
+    return f"{memory_summary}\n{line}" if memory_summary else line
+
+
+_AVAILABLE_TOOLS_DOC = """Available Tools:
 - ask_user_input: Get input from user
 - show_message_to_user: Display message to user
 - api_call: Make API calls to check status/data
 - create_ticket: Create support tickets
-- send_notification: Send notifications
+- send_notification: Send notifications"""
+
+
+def render_available_steps(available_steps: List[str]) -> str:
+    """Numbered SOP step list; rendered once per workflow since the steps never change"""
+    return _NL.join(map("{0}. {1}".format, range(1, len(available_steps) + 1), available_steps))
+
+
+# Each prompt is split static-first: instructions, SOP steps and tool schema
+# form a byte-identical system prompt for the whole workflow so the server's
+# prefix cache can skip prefilling it; the per-step state is the user prompt.
+_STEP_SELECTION_PREAMBLE = """
+You are managing a workflow execution. Analyze the current state and determine:
+1. The next step to execute
+2. What tools you need to use for that step
+
+Available SOP Steps:
+"""
+
+_STEP_SELECTION_INSTRUCTIONS = f"""
+
+{_AVAILABLE_TOOLS_DOC}
 
 Rules:
 1. Don't select completed steps
@@ -39,23 +129,19 @@ Respond with JSON format:
     "required_tools": ["tool1", "tool2"],
     "reasoning": "why this step is next"
 }}
-"""
 
+"""
 
-def build_tool_execution_prompt(current_step: str, tools: LLMTools, user_context: Dict[str, Any], execution_memory: List[ExecutionMemoryDict]) -> str:
-    return f"""
+_TOOL_EXEC_PREAMBLE = """
 You are executing a workflow step. You have access to various tools to complete this step.
 
-Current Step: {current_step}
-
-Available Tools:
-{json.dumps(tools.get_tool_definitions(), indent=2)}
+Workflow Steps:
+"""
 
-User Context (from previous interactions):
-{json.dumps(user_context, indent=2)}
+_TOOL_EXEC_INSTRUCTIONS = f"""
 
-Recent Execution Memory:
-{json.dumps(execution_memory[-3:], indent=2)}
+Available Tools:
+{TOOL_DEFINITIONS_JSON}
 
 Your task is to:
 1. Analyze what this step requires
@@ -80,6 +166,75 @@ If no tools are needed, respond with:
 {{
     "tool_calls": [],
     "reasoning": "This step is complete or no tools needed",
-    "completion_status": "complete"
+    "completion_status": "complete",
+    "next_step_hint": "exact text of the workflow step that should run next, if obvious"
 }}
+
 """
+
+# JSON schemas passed as the generate() format so decoding is constrained to
+# the response shapes described above; reasoning comes last in each
+STEP_SELECTION_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "next_step": {"type": "string"},
+        "required_tools": {"type": "array", "items": {"type": "string"}},
+        "reasoning": {"type": "string"},
+    },
+    "required": ["next_step", "required_tools"],
+}
+
+TOOL_EXECUTION_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "tool_calls": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "tool_name": {"type": "string"},
+                    "parameters": {"type": "object"},
+                },
+                "required": ["tool_name", "parameters"],
+            },
+        },
+        "completion_status": {"type": "string"},
+        "next_step_hint": {"type": "string"},
+        "reasoning": {"type": "string"},
+    },
+    "required": ["tool_calls"],
+}
+
+
+def build_step_selection_system(available_steps_rendered: str) -> str:
+    """Static step-selection instructions; built once per workflow and sent as the system prompt"""
+    return (_STEP_SELECTION_PREAMBLE + available_steps_rendered + _STEP_SELECTION_INSTRUCTIONS).strip()
+
+
+# Literal segments of the per-step user prompts, stitched with "".join
+_STEP_COMPLETED_HEAD = "Completed Steps:\n"
+_MEMORY_HEAD = "\n\nRecent Execution Memory:\n"
+_EARLIER_HEAD = "\n\nEarlier Steps:\n"
+_USER_CONTEXT_HEAD = "User Context (from previous interactions):\n"
+_CURRENT_STEP_HEAD = "\n\nCurrent Step: "
+
+
+def build_step_selection_prompt(completed_steps: List[str], execution_memory: Deque[ExecutionMemoryDict]) -> str:
+    completed = _NL.join(f"- {step}" for step in completed_steps)
+    memory = _NL.join(_dedup_runs(f"- {mem['action']}: {mem['feedback']}" for mem in _project_mem(execution_memory)))
+    return "".join((_STEP_COMPLETED_HEAD, completed, _MEMORY_HEAD, memory, _NL))
+
+
+def build_tool_execution_system(available_steps_rendered: str) -> str:
+    """Static tool-execution instructions and tool schema; built once per workflow and sent as the system prompt"""
+    return (_TOOL_EXEC_PREAMBLE + available_steps_rendered + _TOOL_EXEC_INSTRUCTIONS).strip()
+
+
+def build_tool_execution_prompt(current_step: str, user_context: Dict[str, Any], execution_memory: Deque[ExecutionMemoryDict], memory_summary: str = "") -> str:
+    memory = _NL.join(_dedup_runs(mem["rendered"] for mem in recent_memory(execution_memory)))
+    return "".join((
+        _USER_CONTEXT_HEAD, _fmt_kv(user_context) or "(none)",
+        _EARLIER_HEAD if memory_summary else "", memory_summary,
+        _MEMORY_HEAD, memory,
+        _CURRENT_STEP_HEAD, current_step, _NL,
+    ))